@@ -0,0 +1,2 @@
+# build a standalone Mac application bundle using Nuitka, which compiles the Python code to C
+python -m nuitka --standalone --macos-create-app-bundle --enable-plugin=pyqt5 --macos-app-name="LacCore XRF Converter" --macos-app-icon=assets/laccore.icns --output-dir=dist_xrf_nuitka qtmain_xrf.py
@@ -0,0 +1,2 @@
+# build a standalone Windows application folder using Nuitka, which compiles the Python code to C
+python -m nuitka --standalone --enable-plugin=pyqt5 --windows-console-mode=disable --windows-icon-from-ico=assets\laccore.ico --output-filename="LacCore XRF Converter.exe" --output-dir=dist_xrf_nuitka .\qtmain_xrf.py
@@ -1,7 +1,10 @@
 # Logic common to Geotek and XRF conversion routines
 
 import os, re, sys
-import numpy as np
+
+# NumPy, OpenCV and Numba are imported by the routines that use them rather
+# than here: the GUIs import this module for paths and errors, and shouldn't
+# pay for loading the image libraries before their window is shown.
 
 
 ### I/O helper routines
@@ -10,26 +13,46 @@ import numpy as np
 # beneath destDir if it doesn't exist already. Assumes that
 # destDir already exists.
 def create_dirs(destDir, dirs):
-    for newdir in [os.path.join(destDir, d) for d in dirs]:
-        mkdir_if_needed(newdir)
+    for d in dirs:
+        mkdir_if_needed(os.path.join(destDir, d))
 
+# Create newdir if it doesn't exist already. A single makedirs call
+# avoids the separate stat and the race between checking and creating.
 def mkdir_if_needed(newdir):
-    if not os.path.exists(newdir):
-        os.mkdir(newdir)
+    os.makedirs(newdir, exist_ok=True)
+
+# Return filename (without extension) to use for outputs of input image
+# imgPath: the name of imgPath's parent directory if parentDirBasename is
+# True, otherwise imgPath's own name.
+def get_output_base_name(imgPath, parentDirBasename):
+    return get_output_base_name_func(parentDirBasename)(imgPath)
+
+# Return function of an input image path that returns filename to use for
+# its outputs, as get_output_base_name() does. The naming choice and
+# os.path functions are bound once, for use across a batch of images.
+def get_output_base_name_func(parentDirBasename):
+    basename, dirname, normpath, splitext = os.path.basename, os.path.dirname, os.path.normpath, os.path.splitext
+    if parentDirBasename:
+        return lambda imgPath: basename(dirname(normpath(imgPath)))
+    return lambda imgPath: splitext(basename(imgPath))[0]
+
+# Matches [AppName].app in a Mac application bundle path
+_APP_BUNDLE_RE = re.compile(r"[A-Za-z0-9 \._-]+\.app")
 
 # Return path to directory containing .app bundle, .exe, or Python
 # script launched from command line. Resolves Mac OSX issue with
-# pyinstaller-created .app bundle, for which os.getcwd() returns
+# pyinstaller- or Nuitka-created .app bundle, for which os.getcwd() returns
 # path to the .app bundle's binary.
 def get_app_path():
     # on Mac, we need to find the directory in which the .app bundle lives
     # but os.getcwd() returns the path to the internal binary i.e.
     # /.../[app root]/Contents/MacOS
-    # 'frozen' attr indicates we're running in a pyinstaller-created app bundle
-    if sys.platform == 'darwin' and getattr(sys, 'frozen', False):
+    # 'frozen' attr indicates we're running in a pyinstaller-created app bundle,
+    # Nuitka instead defines __compiled__ in each compiled module
+    if sys.platform == 'darwin' and (getattr(sys, 'frozen', False) or '__compiled__' in globals()):
         binaryPath = sys.executable
         # find instance of [AppName].app
-        match = re.search(r"[A-Za-z0-9 \._-]+\.app", binaryPath)
+        match = _APP_BUNDLE_RE.search(binaryPath)
         if match:
             return binaryPath[:match.start()] # trim everything beyond start of match
         else:
@@ -43,15 +66,23 @@ def get_app_path():
 ### OpenCV image handling routines
 
 # Infer and return color depth from numpy array dtype - 8 or 16 bit,
-# otherwise None.
+# otherwise None. Compare dtype.char codes rather than dtype names,
+# which NumPy would have to parse into a dtype on every call.
 def get_color_depth(img):
-    if img.dtype == 'uint16':
+    c = img.dtype.char
+    if c == 'H': # uint16
         return 16
-    elif img.dtype == 'uint8':
+    elif c == 'B': # uint8
         return 8
     else:
         return None
 
+# Return 8-bit copy of 16-bit img, keeping the high byte of each
+# component. Done with an integer shift rather than scaling by 1/256.0,
+# which would create a float64 temporary.
+def convert_16_to_8bit(img):
+    return (img >> 8).astype('uint8')
+
 # Return pixel component count: 4 for RGBA, 3 for RGB, 1 for grayscale,
 # None for anything else.
 def get_component_count(img):
@@ -70,8 +101,11 @@ def remove_alpha_channel(img):
     return img
 
 # Return three-component RGB image from one-component grayscale.
+# cvtColor writes the interleaved output in a single pass and
+# preserves dtype, so 16-bit grayscale yields 16-bit RGB.
 def grayscale_to_rgb(img):
-    rgb_img = np.stack((img,)*3, axis=-1)
+    import cv2 # OpenCV
+    rgb_img = cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
     return rgb_img
 
 # Return single-component grayscale image from three-component RGB
@@ -89,9 +123,12 @@ def grayscale_to_rgb(img):
 # ...
 #  [gray0, gray1, gray2, gray3 ... grayW-1]] # row H-1.
 # Doesn't matter which of R, G or B we choose since they're all the same.
+#
+# Returns a (non-contiguous) view into img, not a copy. Callers that need
+# an independent array should call .copy() on the result.
 def gray_rgb_to_grayscale(img):
     assert len(img.shape) == 3 and img.shape[2] == 3
-    gs_img = img[:,:,0].copy() # numpy is amazing
+    gs_img = img[:,:,0] # numpy is amazing
     return gs_img
 
 ### Errors
@@ -1,5 +1,5 @@
 # LacCore/CSDCO
-# geotek.py
+# geotek_opencv.py
 #
 # Prepare a raw vertically-oriented Geotek core scanner TIFF image
 # for use by doing the following:
@@ -14,45 +14,134 @@
 # and writing JPEG to ICD dir created in application root directory.
 
 
-import os
+import os, threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import cv2 # OpenCV
 
-from common import create_dirs, UnexpectedColorDepthError, RulerTooShortError, get_component_count, get_color_depth, grayscale_to_rgb, remove_alpha_channel
+from common import create_dirs, UnexpectedColorDepthError, RulerTooShortError, get_component_count, get_color_depth, grayscale_to_rgb, remove_alpha_channel, convert_16_to_8bit
+
+# cv2.imwrite() parameters for each output. Full-size JPEGs keep OpenCV's
+# default quality; downscaled ICD JPEGs use a lower quality and optimized
+# Huffman tables. TIFFs use lossless DEFLATE compression (8 in libtiff) to
+# cut the bytes written for large 16-bit images.
+TiffParams = [cv2.IMWRITE_TIFF_COMPRESSION, 8]
+JpegParams = [cv2.IMWRITE_JPEG_QUALITY, 95]
+IcdJpegParams = [cv2.IMWRITE_JPEG_QUALITY, 85, cv2.IMWRITE_JPEG_OPTIMIZE, 1]
+
+# cv2.resize() interpolation for each prepare_geotek() interp value
+IcdInterpolations = {'area': cv2.INTER_AREA, 'lanczos4': cv2.INTER_LANCZOS4}
+
+# Return interp value suited to scaling the ICD image by icdScaling percent:
+# 'area' when shrinking, which box-averages source pixels and is fastest for
+# integer ratios like 50% or 25%; 'lanczos4' when enlarging, where area
+# interpolation degrades to bilinear.
+def choose_icd_interp(icdScaling):
+    return 'area' if icdScaling <= 100 else 'lanczos4'
 
 ProgressListener = None
+# Guards ProgressListener: keeps concurrent prepare_geotek() reports from
+# interleaving, and a listener change from racing in-flight reports.
+_progressLock = threading.Lock()
 
 def setProgressListener(pl):
     global ProgressListener
-    ProgressListener = pl
-    ProgressListener.clear()
+    with _progressLock:
+        ProgressListener = pl
+        ProgressListener.clear()
 
 def reportProgress(value, text):
-    global ProgressListener
-    if ProgressListener:
-        ProgressListener.setValueAndText(value, text)
+    with _progressLock:
+        if ProgressListener:
+            ProgressListener.setValueAndText(value, text)
+
+# Return (color depth, component count) of img
+def inspect_image(img):
+    return get_color_depth(img), get_component_count(img)
+
+# Decode ruler image file at rulerPath, preserving its color depth. The
+# result can be passed to prepare_geotek() as rulerImg, and shared by concurrent
+# conversions: it's marked read-only, so no conversion can modify it.
+def read_ruler_image(rulerPath):
+    ruler_img = cv2.imread(rulerPath, cv2.IMREAD_UNCHANGED)
+    if ruler_img is not None:
+        ruler_img.setflags(write=False)
+    return ruler_img
+
+# Decode core image file at imgPath, preserving its color depth. Returns
+# None if the file can't be decoded, as cv2.imread() does.
+#
+# The file is memory-mapped and decoded from the mapping, so its bytes are
+# paged in by the OS as the decoder reads them.
+def read_core_image(imgPath):
+    if os.path.getsize(imgPath) == 0:
+        return None # can't map an empty file
+    buf = np.memmap(imgPath, dtype=np.uint8, mode='r')
+    try:
+        if buf[:3].tobytes() == JpegSignature:
+            tj = _get_turbo_jpeg()
+            if tj:
+                return _decode_turbo_jpeg(tj, buf)
+        return cv2.imdecode(buf, cv2.IMREAD_UNCHANGED)
+    finally:
+        del buf # unmap now rather than when garbage collected
+
+JpegSignature = b'\xff\xd8\xff' # first bytes of any JPEG file
+
+# PyTurboJPEG is optional: when it and the libjpeg-turbo library are
+# present, JPEG core images are decoded with libjpeg-turbo's SIMD decoder,
+# otherwise with OpenCV.
+_turboJpeg = None # TurboJPEG decoder, or False if unavailable
+
+# Return TurboJPEG decoder, creating it on first use, or False if unavailable
+def _get_turbo_jpeg():
+    global _turboJpeg
+    if _turboJpeg is None:
+        try:
+            from turbojpeg import TurboJPEG
+            _turboJpeg = TurboJPEG()
+        except (ImportError, OSError, RuntimeError): # module or shared library missing
+            _turboJpeg = False
+    return _turboJpeg
+
+# Decode JPEG bytes buf with TurboJPEG decoder tj. Like cv2.imdecode() with
+# IMREAD_UNCHANGED, yields BGR for color JPEGs and a 2D array for grayscale.
+def _decode_turbo_jpeg(tj, buf):
+    from turbojpeg import TJCS_GRAY, TJPF_BGR, TJPF_GRAY
+    colorspace = tj.decode_header(buf)[3]
+    if colorspace == TJCS_GRAY:
+        return tj.decode(buf, pixel_format=TJPF_GRAY)[:, :, 0]
+    return tj.decode(buf, pixel_format=TJPF_BGR)
 
 # Load ruler image file at rulerPath, convert grayscale to
 # RGB color, adjust depth to match colorDepth.
 def load_ruler_image(rulerPath, colorDepth):
-    ruler_img = cv2.imread(rulerPath, -1) # -1 to preserve file's color depth
-    rulerComponents = get_component_count(ruler_img)
-    rulerDepth = get_color_depth(ruler_img)
+    return prepare_ruler_image(read_ruler_image(rulerPath), colorDepth, rulerPath)
+
+# Convert decoded ruler image ruler_img, loaded from rulerPath, to RGB
+# with depth matching colorDepth, removing alpha channel if needed.
+# ruler_img itself is not modified, so one decoded ruler can be reused
+# for many core images.
+def prepare_ruler_image(ruler_img, colorDepth, rulerPath):
+    rulerDepth, rulerComponents = inspect_image(ruler_img)
     if colorDepth is None:
         raise UnexpectedColorDepthError("Ruler image {} has an unrecognized color depth. Only 16-bit and 8-bit are accepted.".format(rulerPath))
-    if rulerComponents == 1: # grayscale
+    if rulerComponents == 3 and rulerDepth == colorDepth:
+        return ruler_img # common case: ruler already matches core image
+    if rulerComponents == 4:
+        ruler_img = remove_alpha_channel(ruler_img)
+    elif rulerComponents == 1: # grayscale
         print("Converting grayscale ruler to RGB")
         ruler_img = grayscale_to_rgb(ruler_img)
     if rulerDepth == 8 and colorDepth == 16:
         print("Converting 8-bit ruler to 16-bit to match core image")
-        # ruler_img *= 256 alone doesn't work, must explicitly change array dtype
-        # from uint8 to uint16 first
+        # ruler_img <<= 8 alone doesn't work, must explicitly change array dtype
+        # from uint8 to uint16 first. Shifting in place reuses the astype() copy.
         ruler_img = ruler_img.astype('uint16')
-        ruler_img *= 256
+        ruler_img <<= 8
     elif rulerDepth == 16 and colorDepth == 8:
         print("Converting 16-bit ruler to 8-bit to match core image")
-        ruler8bit_img = ruler_img * 1/256.0 # float for Python 2, where 1/256 = 0
-        ruler_img = ruler8bit_img.astype('uint8')
+        ruler_img = convert_16_to_8bit(ruler_img)
     return ruler_img
 
 # imgPath - full path to input Geotek image
@@ -63,72 +152,107 @@ def load_ruler_image(rulerPath, colorDepth):
 # outputBaseName - filename (without extension) to use for outputs - format-appropriate extension will be added
 # destDir - directory in which jpeg, tiff, and ICD dirs will be created,
 # to which image outputs will be written
-def prepare_geotek(imgPath, rulerPath, dpi, trim, icdScaling, outputBaseName, destPath):
+# rulerImg - optional ruler image already decoded from rulerPath, to avoid
+# re-reading the same ruler file for each core image in a batch
+# interp - ICD image resize interpolation, a key of IcdInterpolations, or
+# None to use choose_icd_interp(icdScaling)
+def prepare_geotek(imgPath, rulerPath, dpi, trim, icdScaling, outputBaseName, destPath, rulerImg=None, interp=None):
+    if interp is None:
+        interp = choose_icd_interp(icdScaling)
+    if interp not in IcdInterpolations:
+        raise ValueError("Unknown ICD interpolation '{}', expected one of {}".format(interp, ", ".join(sorted(IcdInterpolations))))
     baseProgStr = "Processing {}...".format(imgPath)
     reportProgress(0, baseProgStr)
     TiffDir, JpegDir, IcdDir = 'tiff', 'jpeg', 'ICD'
     create_dirs(destPath, [TiffDir, JpegDir, IcdDir])
 
     # Load core image
-    img = cv2.imread(imgPath, -1) # -1 to preserve file's color depth
+    img = read_core_image(imgPath)
     print("Image depth: {}".format(img.dtype))
-    colorDepth = get_color_depth(img)
+    colorDepth, coreComponents = inspect_image(img)
     if colorDepth is None:
         raise UnexpectedColorDepthError("Image {} has an unrecognized color depth. Only 16-bit and 8-bit are accepted.".format(imgPath))
     imageWidth = img.shape[0] # this is img.height, but due to upcoming rotation height will be image width
 
     # Load ruler image and confirm it's long enough for core image
-    ruler_img = load_ruler_image(rulerPath, colorDepth)
+    if rulerImg is None:
+        ruler_img = load_ruler_image(rulerPath, colorDepth)
+    else:
+        ruler_img = prepare_ruler_image(rulerImg, colorDepth, rulerPath)
     rulerWidth = ruler_img.shape[1]
     if rulerWidth < imageWidth:
         raise RulerTooShortError("Ruler image {} is too short for core image {}".format(rulerPath, imgPath))
 
-    # Remove alpha channel from core image and ruler image if needed
-    if get_component_count(img) == 4:
+    # Remove alpha channel from core image if needed; prepare_ruler_image()
+    # has already done so for the ruler
+    if coreComponents == 4:
         img = remove_alpha_channel(img)
-    if get_component_count(ruler_img) == 4:
-        ruler_img = remove_alpha_channel(ruler_img)
-
-    # Rotate image 90deg counter-clockwise so core top is at image left
-    reportProgress(10, baseProgStr + "rotating")
-    adj_img = np.rot90(img)
 
-    # Trim [trim] inches from core top (now the left side of image)
-    reportProgress(30, baseProgStr + "trimming {} inches from core top".format(trim))
+    # Allocate output image up front: rotated, trimmed core image with
+    # ruler below it. Rotation, trim and ruler append all write into this
+    # single buffer, avoiding intermediate full-size copies.
     chopWidth = round(dpi * trim)
     # print("chopWidth = {} pixels".format(chopWidth))
-    chop_img = np.delete(adj_img, range(0, chopWidth), axis=1)
+    coreHeight = img.shape[1] # img.width, but due to upcoming rotation width will be image height
+    trimmedWidth = imageWidth - chopWidth
+    tiff_img = np.empty((coreHeight + ruler_img.shape[0], trimmedWidth) + img.shape[2:], dtype=img.dtype)
+
+    # Rotate image 90deg counter-clockwise so core top is at image left, and
+    # trim [trim] inches from core top (now the left side of image). Trimming
+    # the top rows of the unrotated image is equivalent and lets cv2.rotate()
+    # write the result directly into the output buffer.
+    reportProgress(10, baseProgStr + "rotating and trimming {} inches from core top".format(trim))
+    cv2.rotate(img[chopWidth:], cv2.ROTATE_90_COUNTERCLOCKWISE, dst=tiff_img[:coreHeight])
 
     # Trim end of ruler so its width matches trimmed core image width, then
-    # add to bottom of core image. Image widths must be the same to stack vertically
-    # with numpy.concatenate().
+    # copy to bottom of core image.
     reportProgress(60, baseProgStr + "adding ruler")
-    ruler_img = np.delete(ruler_img, range(imageWidth - chopWidth, rulerWidth), axis=1)
-    tiff_img = np.concatenate((chop_img, ruler_img), axis=0)
-
-    # Save as TIFF to tiff subdir
-    reportProgress(70, baseProgStr + "writing TIFF")
-    cv2.imwrite(os.path.join(destPath, TiffDir, outputBaseName + ".tif"), tiff_img)
-
-    # Save as JPEG to jpeg subdir, downscaling 16-bit to 8-bit if needed. JPEG
-    # components must be 8-bit.
-    reportProgress(80, baseProgStr + "writing JPEG")
-    jpeg_img = tiff_img * 1/256.0 if colorDepth == 16 else tiff_img # float for Python 2, where 1/256 = 0
-    cv2.imwrite(os.path.join(destPath, JpegDir, outputBaseName + ".jpg"), jpeg_img)
-
-    # For ICD image, rotate back to vertical (core top at image top),
-    # resize by [icdScaling] percentage and write as JPEG in ICD subdir
-    reportProgress(90, baseProgStr + "writing ICD JPEG")
-    icd_img = np.rot90(jpeg_img, axes=(1,0))
-    icdhit, icdwid = icd_img.shape[:2]
-    scaling = icdScaling/100.0
-    scaled_dims = (int(round(icdwid * scaling)), int(round(icdhit * scaling)))
-    icd_img = cv2.resize(icd_img, scaled_dims, interpolation=cv2.INTER_AREA)
-    cv2.imwrite(os.path.join(destPath, IcdDir, outputBaseName + ".jpg"), icd_img)
+    tiff_img[coreHeight:] = ruler_img[:, :trimmedWidth]
+
+    # Output images are encoded and written on worker threads so the TIFF,
+    # JPEG and ICD writes overlap. OpenCV releases the GIL in imwrite().
+    with ThreadPoolExecutor(max_workers=3) as writer:
+        # Save as TIFF to tiff subdir
+        reportProgress(70, baseProgStr + "writing TIFF")
+        writes = [writer.submit(cv2.imwrite, os.path.join(destPath, TiffDir, outputBaseName + ".tif"), tiff_img, TiffParams)]
+
+        # Save as JPEG to jpeg subdir, downscaling 16-bit to 8-bit if needed. JPEG
+        # components must be 8-bit.
+        reportProgress(80, baseProgStr + "writing JPEG")
+        if colorDepth == 16:
+            jpeg_img = (tiff_img >> 8).astype('uint8') # integer shift, no float64 temporary
+        else:
+            jpeg_img = tiff_img
+        writes.append(writer.submit(cv2.imwrite, os.path.join(destPath, JpegDir, outputBaseName + ".jpg"), jpeg_img, JpegParams))
+
+        # For ICD image, rotate back to vertical (core top at image top),
+        # resize by [icdScaling] percentage and write as JPEG in ICD subdir.
+        # Reuses the 8-bit jpeg_img buffer: rotating it with cv2.rotate()
+        # yields a contiguous uint8 array, which cv2.resize() downscales on
+        # its integer-only INTER_AREA path when interp is 'area'.
+        reportProgress(90, baseProgStr + "writing ICD JPEG")
+        icd_img = cv2.rotate(jpeg_img, cv2.ROTATE_90_CLOCKWISE)
+        icdhit, icdwid = icd_img.shape[:2]
+        scaling = icdScaling/100.0
+        scaled_dims = (int(round(icdwid * scaling)), int(round(icdhit * scaling)))
+        icd_img = cv2.resize(icd_img, scaled_dims, interpolation=IcdInterpolations[interp])
+        writes.append(writer.submit(cv2.imwrite, os.path.join(destPath, IcdDir, outputBaseName + ".jpg"), icd_img, IcdJpegParams))
+
+        for w in writes:
+            w.result() # re-raise any exception from a worker thread
 
 
+# prepare_geotek() can be run on several images concurrently: nearly all of
+# its work happens in OpenCV and NumPy calls that release the GIL, and
+# progress reports are serialized with _progressLock.
 if __name__ == "__main__":
     rulerFiles = ["16bitRGB", "8bitRGB", "16bitGrayscale", "8bitGrayscale"]
-    for rf in rulerFiles:
-        rulerPath = "rulers/Geotek20ppmmRuler{}.tif".format(rf)
-        prepare_geotek('testdata/stubby8bit.tif', rulerPath, dpi=508, trim=0.25, icdScaling=25, outputBaseName="stubby8bit_{}".format(rf), destPath='testdata')
\ No newline at end of file
+    jobs = [("rulers/Geotek20ppmmRuler{}.tif".format(rf), "stubby8bit_{}".format(rf)) for rf in rulerFiles]
+    rulerImages = {} # decode each ruler file once
+    for rulerPath, _ in jobs:
+        if rulerPath not in rulerImages:
+            rulerImages[rulerPath] = read_ruler_image(rulerPath)
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = [executor.submit(prepare_geotek, 'testdata/stubby8bit.tif', rulerPath, dpi=508, trim=0.25, icdScaling=25, outputBaseName=outputBaseName, destPath='testdata', rulerImg=rulerImages[rulerPath]) for rulerPath, outputBaseName in jobs]
+        for f in futures:
+            f.result()
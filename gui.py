@@ -1,9 +1,13 @@
 # LacCore/CSDCO
 # Useful compound GUI objects and methods for PyQt applications.
 
-import logging, os, platform
+import collections, logging, os, platform
 
-from PyQt5 import QtWidgets, QtCore
+from PyQt5 import QtWidgets, QtCore, QtGui
+
+# platform.system() calls uname() each time, so check once at import
+_IS_WINDOWS = platform.system() == "Windows"
+_IS_DARWIN = platform.system() == "Darwin"
 
 def warnbox(parent, title="Warning", message=""):
     QtWidgets.QMessageBox.warning(parent, title, message)
@@ -18,25 +22,41 @@ def promptbox(parent, title="Prompt", message=""):
     response = QtWidgets.QMessageBox.question(parent, title, message)
     return response == QtWidgets.QMessageBox.Yes
 
+# File dialogs use Qt's own dialog rather than the platform's native one,
+# which on some systems stats every entry in the directory and can freeze
+# the app for many seconds. Set to True to use native dialogs instead.
+UseNativeFileDialogs = False
+
+def _makeFileDialog(parent, caption, path, fileMode, acceptMode=QtWidgets.QFileDialog.AcceptOpen):
+    dlg = QtWidgets.QFileDialog(parent, caption, path)
+    dlg.setOption(QtWidgets.QFileDialog.DontUseNativeDialog, not UseNativeFileDialogs)
+    dlg.setOption(QtWidgets.QFileDialog.DontResolveSymlinks, True)
+    dlg.setFileMode(fileMode)
+    dlg.setAcceptMode(acceptMode)
+    return dlg
+
 def chooseDirectory(parent, path=""):
-    dlg = QtWidgets.QFileDialog(parent, "Choose directory", path)
-    selectedDir = dlg.getExistingDirectory(parent)
+    dlg = _makeFileDialog(parent, "Choose directory", path, QtWidgets.QFileDialog.Directory)
+    dlg.setOption(QtWidgets.QFileDialog.ShowDirsOnly, True)
+    selectedDir = dlg.selectedFiles()[0] if dlg.exec_() else ""
     return selectedDir
 
+# chooseFile(), chooseFiles() and chooseSaveFile() return a (selection,
+# selected filter) tuple like the QFileDialog static methods they replace
 def chooseFile(parent, path=""):
-    dlg = QtWidgets.QFileDialog(parent, "Choose file", path)
-    chosenFile = dlg.getOpenFileName(parent)
-    return chosenFile
+    dlg = _makeFileDialog(parent, "Choose file", path, QtWidgets.QFileDialog.ExistingFile)
+    chosenFile = dlg.selectedFiles()[0] if dlg.exec_() else ""
+    return (chosenFile, dlg.selectedNameFilter())
 
 def chooseFiles(parent, path=""):
-    dlg = QtWidgets.QFileDialog(parent, "Choose file(s)", path)
-    chosenFiles = dlg.getOpenFileNames(parent)
-    return chosenFiles
+    dlg = _makeFileDialog(parent, "Choose file(s)", path, QtWidgets.QFileDialog.ExistingFiles)
+    chosenFiles = dlg.selectedFiles() if dlg.exec_() else []
+    return (chosenFiles, dlg.selectedNameFilter())
 
 def chooseSaveFile(parent, path=""):
-    dlg = QtWidgets.QFileDialog(parent, "Save file", path)
-    saveFile = dlg.getSaveFileName(parent)
-    return saveFile
+    dlg = _makeFileDialog(parent, "Save file", path, QtWidgets.QFileDialog.AnyFile, QtWidgets.QFileDialog.AcceptSave)
+    saveFile = dlg.selectedFiles()[0] if dlg.exec_() else ""
+    return (saveFile, dlg.selectedNameFilter())
 
 
 # Provides file drag and drop support. Inheriting classes must call
@@ -71,6 +91,7 @@ class DragAndDropMixin:
 class FileListPanel(QtWidgets.QWidget, DragAndDropMixin):
     def __init__(self, title):
         QtWidgets.QWidget.__init__(self)
+        self._paths = [] # file paths in list order, mirrors sslist items
         self.initUI(title)
         self.setAcceptDrops(True)
         self.setAcceptMethod(self.addFiles)        
@@ -95,26 +116,35 @@ class FileListPanel(QtWidgets.QWidget, DragAndDropMixin):
         
     def addFile(self, newfile):
         self.sslist.addItem(QtWidgets.QListWidgetItem(newfile))
+        self._paths.append(newfile)
         self._enableRemove()
         
+    # add all files in one call, repainting the list once
     def addFiles(self, filelist):
-        for f in filelist:
-            self.addFile(f)
+        filelist = list(filelist)
+        self.sslist.setUpdatesEnabled(False)
+        self.sslist.addItems(filelist)
+        self.sslist.setUpdatesEnabled(True)
+        self._paths.extend(filelist)
+        self._enableRemove()
         
     def getFiles(self):
-        return [self.sslist.item(idx).text() for idx in range(self.sslist.count())]
+        return list(self._paths)
 
     def clear(self):
         self.sslist.clear()
+        self._paths = []
 
     def onAdd(self):
         files = chooseFiles(self)
-        for f in files[0]:
-            self.addFile(f)
+        self.addFiles(files[0])
         
     def onRemove(self):
-        for sel in self.sslist.selectedItems():
-            self.sslist.takeItem(self.sslist.row(sel))
+        # remove from the end so remaining row indices stay valid
+        rows = sorted((self.sslist.row(sel) for sel in self.sslist.selectedItems()), reverse=True)
+        for row in rows:
+            self.sslist.takeItem(row)
+            del self._paths[row]
         self._enableRemove()
             
     def _enableRemove(self):
@@ -310,32 +340,106 @@ class ProgressPanel(QtWidgets.QWidget):
         layout.addWidget(self.label)
         layout.addWidget(self.progress)
 
+        # Progress reports only record the latest value and text; a timer
+        # applies them to the widgets at most 20 times per second. The timer
+        # runs only while reports arrive: the first report starts it, and it
+        # stops at the first tick with nothing new.
+        self._pendingVal = 0
+        self._pendingText = ""
+        self._dirty = False
+        self._flushTimer = QtCore.QTimer(self)
+        self._flushTimer.setInterval(50)
+        self._flushTimer.timeout.connect(self._flush)
+
     def setValue(self, val):
         self.progress.setValue(val)
 
     def setText(self, text):
         self.label.setText(text)
 
+    @QtCore.pyqtSlot(int, str)
     def setValueAndText(self, val, text):
-        self.setValue(val)
-        self.setText(text)
-        self._update()
+        self._pendingVal = val
+        self._pendingText = text
+        self._dirty = True
+        if not self._flushTimer.isActive():
+            self._flushTimer.start()
+
+    def _flush(self):
+        if not self._dirty:
+            self._flushTimer.stop()
+            return
+        self._dirty = False
+        self.setValue(self._pendingVal)
+        self.setText(self._pendingText)
+
+    # reset immediately rather than on the next timer tick
+    def clear(self):
+        self.setValueAndText(0, "")
+        self._flush()
+
 
-    def _update(self):
-        self.parent.app.processEvents()
+# Signals shared by ConversionTasks running on a QThreadPool. Serves as a
+# processing module's progress listener: setValueAndText() calls made on
+# pool threads are relayed to the GUI thread as progress signals.
+class ConversionSignals(QtCore.QObject):
+    progress = QtCore.pyqtSignal(int, str)
+    fileDone = QtCore.pyqtSignal(str, bool, str, str) # image path, success, error title, error message
+
+    def setValueAndText(self, val, text):
+        self.progress.emit(val, text)
 
     def clear(self):
         self.setValueAndText(0, "")
 
 
-# Handler to direct python logging output to QTextEdit control
+# Converts a single image on a QThreadPool thread by calling func(*args),
+# then emits signals.fileDone. Exceptions that are instances of a class in
+# errorTitles, a list of (exception class, error title) pairs, are reported
+# with that title; anything else is reported as an unhandled error.
+class ConversionTask(QtCore.QRunnable):
+    def __init__(self, signals, imgPath, func, args, errorTitles):
+        QtCore.QRunnable.__init__(self)
+        self.signals = signals
+        self.imgPath = imgPath
+        self.func = func
+        self.args = args
+        self.errorTitles = errorTitles
+
+    def run(self):
+        success, title, message = False, "", ""
+        try:
+            self.func(*self.args)
+            success = True
+        except Exception as e:
+            for excClass, excTitle in self.errorTitles:
+                if isinstance(e, excClass):
+                    title, message = excTitle, "{}".format(e)
+                    break
+            else:
+                title, message = "Process failed", "Unhandled error {}: {}".format(type(e).__name__, e)
+                logging.exception("Conversion of {} failed".format(self.imgPath))
+        self.signals.fileDone.emit(self.imgPath, success, title, message)
+
+
+# Carries formatted log records from any thread to the GUI thread
+class _LogRecordRelay(QtCore.QObject):
+    record = QtCore.pyqtSignal(str)
+
+
+# Handler to direct python logging output to QPlainTextEdit control.
+# Only the most recent maxBlockCount lines are kept. Records may be
+# logged from any thread: emit() only sends a queued signal, and the
+# control is updated on the GUI thread.
 class LogTextArea(logging.Handler):
-    def __init__(self, parent, label):
+    def __init__(self, parent, label, maxBlockCount=2000):
         self.parent = parent
         self.layout = QtWidgets.QVBoxLayout()
         logging.Handler.__init__(self)
-        self.logText = QtWidgets.QTextEdit(parent)
+        self.logText = QtWidgets.QPlainTextEdit(parent)
         self.logText.setReadOnly(True)
+        self.logText.setUndoRedoEnabled(False)
+        self.logText.setMaximumBlockCount(maxBlockCount)
         self.logText.setToolTip("It's all happening.")
         
         self.layout.setContentsMargins(0,0,0,0)
@@ -343,16 +447,53 @@ class LogTextArea(logging.Handler):
         self.layout.addWidget(QtWidgets.QLabel(label))
         self.layout.addWidget(self.logText)
         
+        # Unless verbose, DEBUG records are rejected by logging.Handler.handle()
+        # before emit(), so they are never formatted.
         self.verboseCheckbox = QtWidgets.QCheckBox("Include Debugging Information")
+        self.verboseCheckbox.toggled.connect(self._onVerboseToggled)
         self.layout.addWidget(self.verboseCheckbox)
+        self._onVerboseToggled(self.verboseCheckbox.isChecked())
+
+        # Records are buffered as they arrive and appended to logText in a
+        # single insert per timer tick, at most 20 times per second. If the
+        # buffer fills between ticks, the oldest records are dropped. The
+        # timer runs only while records arrive: the first record starts it,
+        # and it stops at the first tick with an empty buffer.
+        self._records = collections.deque(maxlen=1000)
+        self._relay = _LogRecordRelay(self.logText)
+        self._relay.record.connect(self._appendRecord, QtCore.Qt.QueuedConnection)
+        self._flushTimer = QtCore.QTimer(self.logText)
+        self._flushTimer.setInterval(50)
+        self._flushTimer.timeout.connect(self._flush)
         
     def isVerbose(self):
         return self.verboseCheckbox.isChecked()
 
+    def _onVerboseToggled(self, verbose):
+        self.setLevel(logging.DEBUG if verbose else logging.INFO)
+
     def emit(self, record):
-        msg = self.format(record)
-        self.logText.insertPlainText(msg + "\n")
-        self.parent.app.processEvents()
+        self._relay.record.emit(self.format(record))
+
+    # runs on the GUI thread
+    def _appendRecord(self, msg):
+        self._records.append(msg)
+        if not self._flushTimer.isActive():
+            self._flushTimer.start()
+
+    def _flush(self):
+        if len(self._records) == 0:
+            self._flushTimer.stop()
+            return
+        msgs = []
+        while self._records:
+            msgs.append(self._records.popleft())
+        cursor = QtGui.QTextCursor(self.logText.document())
+        cursor.movePosition(QtGui.QTextCursor.End)
+        cursor.insertText("\n".join(msgs) + "\n")
+        # scroll to newest records once per flush, not once per record
+        scrollBar = self.logText.verticalScrollBar()
+        scrollBar.setValue(scrollBar.maximum())
 
     def write(self, m):
         pass
@@ -377,13 +518,16 @@ def HelpTextDecorator(widget, helpText, spacing=5):
 
 # create appropriately-sized labels for the current OS
 class LabelFactory:
+    ItemLabelStyle = "QLabel {font-weight: bold;}"
+    DescLabelStyle = "QLabel {font-size: 11pt;}"
+
     # main label for an item
     # On Mac, use standard font. On Windows, bold font.
     @classmethod
     def makeItemLabel(cls, text):
         label = QtWidgets.QLabel(text)
-        if platform.system() == "Windows":
-            label.setStyleSheet("QLabel {font-weight: bold;}")
+        if _IS_WINDOWS:
+            label.setStyleSheet(cls.ItemLabelStyle)
         return label
     
     # label for help/description text
@@ -391,7 +535,7 @@ class LabelFactory:
     @classmethod
     def makeDescLabel(cls, text):
         label = QtWidgets.QLabel(text)
-        if platform.system() == "Darwin":
-            label.setStyleSheet("QLabel {font-size: 11pt;}")
+        if _IS_DARWIN:
+            label.setStyleSheet(cls.DescLabelStyle)
         return label
     
\ No newline at end of file
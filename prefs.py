@@ -1,41 +1,92 @@
-# Get/set/read/write preference data to/from a Python pickle file
+# Get/set/read/write preference data to/from a JSON file
 
+import json
 import logging
 import os
-import pickle
 
 logger = logging.getLogger(__name__)
 
+PickleMagic = b'\x80' # first byte of files written by pickle protocol 2+
+
+# Return pref value as a JSON-serializable value: rectangles such as
+# QRect are stored as [x, y, width, height] lists.
+def _encode(value):
+    if hasattr(value, 'getRect'):
+        return list(value.getRect())
+    return value
+
 class Preferences:
-    # prefPath - path to preferences pickle file to be used, which will
+    # prefPath - path to preferences JSON file to be used, which will
     # be created if it doesn't exist. Assumes parent directory already
-    # exists.
+    # exists. The file isn't read until preferences are first accessed.
     def __init__(self, prefPath):
         self.prefPath = prefPath
 
         self.prefmap = {}
-        self.read()
+        self._loaded = False
+        self._dirty = False # prefmap has changes not yet written
 
+    # read prefs file if that hasn't happened yet
+    def _ensure(self):
+        if not self._loaded:
+            self.read()
+
+    # Write prefs if they've changed. Prefs are written to a temporary file
+    # which then replaces the prefs file, so a crash mid-write can't leave
+    # a truncated prefs file behind.
     def write(self):
-        with open(self.prefPath, 'wb') as pf:
-            pickle.dump(self.prefmap, pf)
-            pf.close()
-            logger.info("saved preferences: " + str(self.prefmap))
+        if not self._dirty:
+            return
+        tmpPath = self.prefPath + ".tmp"
+        with open(tmpPath, 'w') as pf:
+            json.dump({k: _encode(v) for k, v in self.prefmap.items()}, pf)
+        os.replace(tmpPath, self.prefPath)
+        self._dirty = False
+        logger.info("saved preferences: %s", self.prefmap)
 
     def read(self):
         if os.path.exists(self.prefPath):
-            pf = open(self.prefPath, 'rb')
-            self.prefmap = pickle.load(pf)
-            pf.close()
-            logger.info("loaded prefs: " + str(self.prefmap))
+            with open(self.prefPath, 'rb') as pf:
+                data = pf.read()
+            if data.startswith(PickleMagic):
+                self._migratePickle(data)
+            else:
+                try:
+                    self.prefmap = json.loads(data.decode('utf-8'))
+                except ValueError:
+                    logger.warning("couldn't parse prefs at %s, using defaults", self.prefPath)
+                    self.prefmap = {}
+            logger.info("loaded prefs: %s", self.prefmap)
         else:
-            logger.info("no prefs found at " + self.prefPath)
+            logger.info("no prefs found at %s", self.prefPath)
+        self._loaded = True
+
+    # Earlier versions wrote prefs with pickle. Load them and immediately
+    # rewrite as JSON; pickle is only imported for this one-time conversion.
+    # The rewrite is best-effort: if it fails, e.g. in a read-only app
+    # directory, the converted prefs stay in memory, still marked dirty,
+    # and the next write() tries again.
+    def _migratePickle(self, data):
+        import pickle
+        self.prefmap = {k: _encode(v) for k, v in pickle.loads(data).items()}
+        self._dirty = True
+        try:
+            self.write()
+        except OSError as e:
+            logger.warning("couldn't rewrite pickled prefs at %s as JSON: %s", self.prefPath, e)
+            return
+        logger.info("converted pickled prefs at %s to JSON", self.prefPath)
 
     def contains(self, key):
+        self._ensure()
         return key in self.prefmap
 
     def get(self, key, default=""):
+        self._ensure()
         return self.prefmap[key] if key in self.prefmap else default
     
     def set(self, key, value):
-        self.prefmap[key] = value
+        self._ensure()
+        if key not in self.prefmap or self.prefmap[key] != value:
+            self.prefmap[key] = value
+            self._dirty = True
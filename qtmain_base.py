@@ -0,0 +1,301 @@
+# LacCore/CSDCO
+# qtmain_base.py
+# MainWindow behavior shared by the Geotek and XRF GUIs
+
+import abc, logging, os
+
+from PyQt5 import QtCore, QtWidgets
+
+import common
+from gui import FileListPanel, errbox, infobox, ConversionSignals, ConversionTask, LabelFactory, ProgressPanel, TwoButtonPanel
+from prefs import Preferences
+
+_RULER_LBL = "Ruler:"
+_OUTPUT_NAMING_LBL = "Output Naming:"
+_OUTPUT_NAMING_ITEMS = ["Use input file's name", "Use name of input file's parent directory"]
+
+# QDialog's metaclass combined with ABCMeta, so MainWindowBase can declare
+# abstract methods
+class _MainWindowMeta(type(QtWidgets.QDialog), abc.ABCMeta):
+    pass
+
+
+# Image converter window: image list, converter-specific settings, ruler
+# and output naming selection, and conversion on a thread pool.
+#
+# Subclasses set the class attributes below and implement the abstract
+# methods: importBackend() and the settings hooks initSettingsGUI(),
+# installSettingsPrefs(), saveSettingsPrefs(), parseSettings() and
+# conversionJobArgs().
+class MainWindowBase(QtWidgets.QDialog, metaclass=_MainWindowMeta):
+    VERSION = ""
+    Title = "" # window title, version is appended
+    ListLabel = "Images to be converted: click Add, or drag and drop files in the list below to add images."
+    ConvertFuncName = "" # backend function converting a single image, return value unused
+    ErrorTitles = [] # (exception class, dialog title) of expected conversion errors
+    PrefsFileName = "prefs.pk" # in application directory
+    ShowOutputNaming = True # if False, outputs are always named for input file
+    MaxConcurrentConversions = 4
+
+    def __init__(self):
+        QtWidgets.QDialog.__init__(self)
+        self.app_path = None # init'd in self.initAppPath()
+        self._backend = None # init'd in self.backend()
+
+        self.initAppPath()
+        self._rulersDir = os.path.join(self.app_path, "rulers")
+        self.initGUI()
+        self.installRulers()
+        self.initPrefs()
+        self.initConversion()
+
+    def initGUI(self):
+        self.setWindowTitle("{} v{}".format(self.Title, self.VERSION))
+
+        vlayout = QtWidgets.QVBoxLayout(self)
+
+        self.imageList = FileListPanel(self.ListLabel)
+        self.imageList.addButton.setAutoDefault(False)
+        self.imageList.rmButton.setAutoDefault(False)
+        vlayout.addWidget(self.imageList, 1)
+
+        self.initSettingsGUI(vlayout)
+
+        rulerLayout = QtWidgets.QHBoxLayout()
+        self.rulerCombo = QtWidgets.QComboBox()
+        self.rulerCombo.setSizePolicy(QtWidgets.QSizePolicy.Expanding, self.rulerCombo.sizePolicy().verticalPolicy())
+        rulerLayout.addWidget(LabelFactory.makeItemLabel(_RULER_LBL))
+        rulerLayout.addWidget(self.rulerCombo)
+        vlayout.addLayout(rulerLayout, 0)
+
+        outputNamingLayout = QtWidgets.QHBoxLayout()
+        self.outputNamingCombo = QtWidgets.QComboBox()
+        self.outputNamingCombo.addItems(_OUTPUT_NAMING_ITEMS)
+        self.outputNamingCombo.setSizePolicy(QtWidgets.QSizePolicy.Expanding, self.outputNamingCombo.sizePolicy().verticalPolicy())
+        outputNamingLayout.addWidget(LabelFactory.makeItemLabel(_OUTPUT_NAMING_LBL))
+        outputNamingLayout.addWidget(self.outputNamingCombo)
+        if self.ShowOutputNaming:
+            vlayout.addLayout(outputNamingLayout)
+
+        self.saveDefaultsButton = QtWidgets.QPushButton("Save Settings as Default")
+        self.saveDefaultsButton.clicked.connect(self.saveDefaultSettings)
+        self.saveDefaultsButton.setAutoDefault(False)
+        self.convertButton = QtWidgets.QPushButton("Convert Images")
+        self.convertButton.clicked.connect(self.processImageFiles)
+        self.convertButton.setAutoDefault(False)
+        self.buttonPanel = TwoButtonPanel(self.saveDefaultsButton, self.convertButton)
+
+        self.progressPanel = ProgressPanel(self)
+        # Buttons and progress share a slot in the layout, only one is shown
+        # at a time. Same size policy and height so swapping them doesn't
+        # resize the image list above.
+        self.progressPanel.setSizePolicy(self.buttonPanel.sizePolicy())
+        panelHeight = max(self.buttonPanel.sizeHint().height(), self.progressPanel.sizeHint().height())
+        self.buttonPanel.setMinimumHeight(panelHeight)
+        self.progressPanel.setMinimumHeight(panelHeight)
+        self.progressPanel.setVisible(False)
+
+        vlayout.addWidget(self.buttonPanel, stretch=0)
+        vlayout.addWidget(self.progressPanel, stretch=0)
+
+    # Add converter-specific settings widgets to vlayout, between the
+    # image list and ruler selection.
+    @abc.abstractmethod
+    def initSettingsGUI(self, vlayout):
+        pass
+
+    # Hide the outgoing panel before showing the other: if both are briefly
+    # visible, the layout's minimum height grows and the window with it.
+    def showProgressLayout(self, show):
+        hidden, shown = (self.buttonPanel, self.progressPanel) if show else (self.progressPanel, self.buttonPanel)
+        hidden.setVisible(False)
+        shown.setVisible(True)
+
+    # Images are converted concurrently by ConversionTasks on a thread pool.
+    # Each conversion holds several full-size copies of its image in memory,
+    # so the number of concurrent conversions is capped.
+    def initConversion(self):
+        self.convertPool = QtCore.QThreadPool(self)
+        self.convertPool.setMaxThreadCount(min(QtCore.QThread.idealThreadCount(), self.MaxConcurrentConversions))
+        self.convertSignals = ConversionSignals()
+        self.convertSignals.progress.connect(self.onConversionProgress, QtCore.Qt.QueuedConnection)
+        self.convertSignals.fileDone.connect(self.onImageConverted, QtCore.Qt.QueuedConnection)
+        self.jobCount = 0 # images in conversion in progress, 0 if none
+        self.convertedCount = 0
+        self.failures = [] # (error title, error message) of each failed image
+
+    # Return conversion module, importing it on first use. It loads OpenCV
+    # and NumPy, which would otherwise delay showing the window.
+    def backend(self):
+        if self._backend is None:
+            self._backend = self.importBackend()
+        return self._backend
+
+    # Import and return conversion module, which provides ConvertFuncName,
+    # read_ruler_image() and setProgressListener().
+    @abc.abstractmethod
+    def importBackend(self):
+        pass
+
+    def isConverting(self):
+        return self.jobCount > 0
+
+    def initAppPath(self):
+        try:
+            self.app_path = common.get_app_path()
+        except common.InvalidApplicationPathError as iape:
+            errbox(self, "Invalid Application Path", "Couldn't find application directory, exiting.")
+            raise iape # re-raise and bail
+
+    # The prefs file is read and applied once the event loop is running,
+    # so the window paints before the file is parsed.
+    def initPrefs(self):
+        prefPath = os.path.join(self.app_path, self.PrefsFileName)
+        self.prefs = Preferences(prefPath)
+        QtCore.QTimer.singleShot(0, self.installPrefs)
+
+    def installRulers(self):
+        rulersPath = self._rulersDir
+        try:
+            common.mkdir_if_needed(rulersPath)
+        except Exception as e:
+            errbox(self, "Process failed", "Failed to create {}.\nUnhandled error {}: {}".format(rulersPath, type(e).__name__, e))
+            logging.exception("Failed to create {}".format(rulersPath))
+        # scandir() entries carry file type from the directory read, avoiding
+        # a stat() per file. Only symlinks are stat()ed, so that a link to a
+        # ruler file is listed as the ruler file would be.
+        with os.scandir(rulersPath) as entries:
+            rulerFiles = [e.name for e in entries if e.is_file()
+                and not e.name.startswith('.')] # no hidden files
+        rulerFiles.sort()
+        if len(rulerFiles) == 0:
+            errbox(self, message="No ruler files were found. Add one or more ruler files to the rulers folder and restart.")
+        else:
+            self.rulerCombo.addItems(rulerFiles)
+
+    def installPrefs(self):
+        geom = self.prefs.get("windowGeometry", None) # [x, y, width, height]
+        if geom is not None:
+            self.setGeometry(QtCore.QRect(*geom))
+        self.installSettingsPrefs()
+        ruler = self.prefs.get("ruler", "")
+        rulerIdx = self.rulerCombo.findText(ruler)
+        self.rulerCombo.setCurrentIndex(rulerIdx if rulerIdx >= 0 else 0)
+        # default to input file name
+        self.outputNamingCombo.setCurrentIndex(self.prefs.get("outputNaming", 0))
+
+    # Fill converter-specific settings widgets from self.prefs.
+    @abc.abstractmethod
+    def installSettingsPrefs(self):
+        pass
+
+    def savePrefs(self):
+        self.prefs.set("windowGeometry", list(self.geometry().getRect()))
+        self.prefs.write()
+
+    # Defaults are written once control returns to the event loop rather
+    # than in the click handler; closeEvent() writes any later changes.
+    def saveDefaultSettings(self):
+        self.saveSettingsPrefs()
+        self.prefs.set("ruler", self.rulerCombo.currentText())
+        self.prefs.set("outputNaming", self.outputNamingCombo.currentIndex())
+        QtCore.QTimer.singleShot(0, self.prefs.write)
+
+    # Store converter-specific settings widget values in self.prefs.
+    @abc.abstractmethod
+    def saveSettingsPrefs(self):
+        pass
+
+    # override QWidget.closeEvent()
+    def closeEvent(self, event):
+        if self.isConverting():
+            infobox(self, "Conversion In Progress", "Please wait for image conversion to finish before closing.")
+            event.ignore()
+            return
+        self.savePrefs()
+        event.accept() # allow window to close - event.ignore() to veto close
+
+    def getRulerPath(self):
+        return os.path.join(self._rulersDir, str(self.rulerCombo.currentText()))
+
+    # Validate and return a tuple of converter-specific settings, or None
+    # after reporting the problem if any setting is invalid.
+    @abc.abstractmethod
+    def parseSettings(self):
+        pass
+
+    # Return list of (image path, ConvertFunc args) for each job in jobs,
+    # a list of (image path, output base name) tuples.
+    @abc.abstractmethod
+    def conversionJobArgs(self, jobs, rulerPath, settings):
+        pass
+
+    def processImageFiles(self):
+        imgFiles = self.imageList.getFiles()
+        if len(imgFiles) == 0:
+            infobox(self, "No Images", "Add at least one image to be converted.")
+            return
+
+        settings = self.parseSettings()
+        if settings is None:
+            return
+        parentDirBasename = self.ShowOutputNaming and self.outputNamingCombo.currentIndex() == 1
+        nameFn = common.get_output_base_name_func(parentDirBasename)
+        jobs = [(imgPath, nameFn(imgPath)) for imgPath in imgFiles]
+
+        # Import the backend and build every job's args, which decodes the
+        # ruler, before entering progress mode: if either fails, the window
+        # is left as it was rather than stuck converting nothing.
+        try:
+            backend = self.backend()
+            convertFunc = getattr(backend, self.ConvertFuncName)
+            jobArgs = self.conversionJobArgs(jobs, self.getRulerPath(), settings)
+        except Exception as e:
+            errbox(self, "Process failed", "Failed to start conversion.\nUnhandled error {}: {}".format(type(e).__name__, e))
+            logging.exception("Failed to start conversion")
+            return
+
+        # Convert on the thread pool. Progress and completion are delivered
+        # to the GUI thread through queued signals, so the window stays
+        # responsive without pumping the event loop.
+        self.showProgressLayout(True)
+        self.progressPanel.clear()
+        self.convertButton.setEnabled(False)
+        self.jobCount, self.convertedCount, self.failures = len(jobArgs), 0, []
+        backend.setProgressListener(self.convertSignals)
+        for imgPath, args in jobArgs:
+            self.convertPool.start(ConversionTask(self.convertSignals, imgPath, convertFunc, args, self.ErrorTitles))
+
+    def _overallProgress(self):
+        return int(100 * self.convertedCount / self.jobCount)
+
+    # Progress reports from concurrent conversions update the text; the bar
+    # shows the share of images converted so far.
+    @QtCore.pyqtSlot(int, str)
+    def onConversionProgress(self, val, text):
+        if self.isConverting():
+            self.progressPanel.setValueAndText(self._overallProgress(), text)
+
+    @QtCore.pyqtSlot(str, bool, str, str)
+    def onImageConverted(self, imgPath, success, errTitle, errMessage):
+        self.convertedCount += 1
+        if not success:
+            self.failures.append((errTitle, errMessage))
+        self.progressPanel.setValueAndText(self._overallProgress(), "Converted {} of {} images".format(self.convertedCount, self.jobCount))
+        if self.convertedCount == self.jobCount:
+            self.onConversionDone()
+
+    def onConversionDone(self):
+        imgCount = self.jobCount
+        self.jobCount = 0
+        if len(self.failures) > 0:
+            errTitle, errMessage = self.failures[0]
+            if len(self.failures) > 1:
+                errMessage += "\n\n{} of {} images failed to convert.".format(len(self.failures), imgCount)
+            errbox(self, errTitle, errMessage)
+        self.showProgressLayout(False)
+        self.progressPanel.clear()
+        self.convertButton.setEnabled(True)
+        if len(self.failures) == 0:
+            infobox(self, "Yay!", "Successfully converted {} image files.".format(imgCount))
+            self.imageList.clear()
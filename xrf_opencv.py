@@ -1,5 +1,5 @@
 # LacCore/CSDCO
-# xrf.py
+# xrf_opencv.py
 #
 # Prepare a raw XRF radiograph TIFF by doing the following:
 # 1. Rotate image 180 degrees.
@@ -9,78 +9,133 @@
 # 3. Add ruler image below XRF image.
 # 4. Save resulting image in TIFF format.
 
-import os
+import functools, os, threading
 import cv2 # OpenCV
 import numpy
 
-from common import create_dirs, get_color_depth, get_component_count, remove_alpha_channel, UnexpectedColorDepthError, RulerTooShortError, UnexpectedComponentCountError
+from common import convert_16_to_8bit, create_dirs, get_color_depth, get_component_count, remove_alpha_channel, UnexpectedColorDepthError, RulerTooShortError, UnexpectedComponentCountError
 
 ProgressListener = None
+# Guards ProgressListener: keeps concurrent prepare_xrf() reports from
+# interleaving, and a listener change from racing in-flight reports.
+_progressLock = threading.Lock()
 
 def setProgressListener(pl):
     global ProgressListener
-    ProgressListener = pl
-    ProgressListener.clear()
+    with _progressLock:
+        ProgressListener = pl
+        ProgressListener.clear()
 
 def reportProgress(value, text):
-    global ProgressListener
-    if ProgressListener:
-        ProgressListener.setValueAndText(value, text)
-
-class ContrastAdjuster:
-    def __init__(self, minv, maxv, gamma, pixeldepth):
-        self.minv = minv
-        self.maxv = maxv
-        self._interval = self.maxv - self.minv
-        self._invgamma = 1.0/gamma
-        self.pixeldepth = pixeldepth
-
-    def new_level(self, value):
-        if value <= self.minv:
-            return 0.0
-        if value >= self.maxv:
-            return 1.0
-        return ((value - self.minv) / float(self._interval)) ** self._invgamma
-
-    def adjust(self, val):
-        # print("val = {}".format(val))
-        return int(self.pixeldepth * self.new_level(val))
-
-# Return min and max pixel value in img.
+    with _progressLock:
+        if ProgressListener:
+            ProgressListener.setValueAndText(value, text)
+
+# Return lookup table of the contrast-adjusted uint16 value of every
+# colorDepth-bit pixel value: values <= minv map to black, values >= maxv to
+# white, and values between are interpolated with gamma correction. Works
+# in float64, in place on a single temporary, truncating toward zero.
+def make_contrast_lut(minv, maxv, gamma, colorDepth):
+    valueCount = 2 ** colorDepth
+    if maxv == minv: # flat image: every pixel is <= minv
+        return numpy.zeros(valueCount, dtype='uint16')
+    levels = numpy.arange(valueCount, dtype=numpy.float64)
+    numpy.subtract(levels, minv, out=levels)
+    numpy.divide(levels, float(maxv - minv), out=levels)
+    numpy.clip(levels, 0.0, 1.0, out=levels)
+    numpy.power(levels, 1.0/gamma, out=levels)
+    numpy.multiply(levels, valueCount - 1, out=levels)
+    return levels.astype('uint16')
+
+# Return min and max pixel value in single-component img. OpenCV finds
+# both in one vectorized pass, but copies non-contiguous input first, so
+# pass an unrotated image where possible.
 def get_pixel_range(img):
-    pmin = None
-    pmax = None
-    for row_idx in range(len(img)):
-        rmin = min(img[row_idx])
-        rmax = max(img[row_idx])
-        if pmin is None or rmin < pmin:
-            pmin = rmin
-        if pmax is None or rmax > pmax:
-            pmax = rmax
-    return pmin, pmax
-
-# Count unique pixels in image. Slow.
+    pmin, pmax = cv2.minMaxLoc(img)[:2]
+    return int(pmin), int(pmax)
+
+# Count unique pixels in image. For 8- and 16-bit images, counts the
+# occupied bins of a histogram over every possible value in one pass.
 def count_unique_pixels(img):
-    pixs = []
-    for row_idx in range(len(img)):
-        for p in img[row_idx]:
-            if p not in pixs:
-                pixs.append(p)
-    return len(pixs)
+    colorDepth = get_color_depth(img)
+    if colorDepth is None:
+        return int(numpy.unique(img).size)
+    return int(numpy.count_nonzero(numpy.bincount(img.ravel(), minlength=1 << colorDepth)))
+
+_lookup_kernel = None # compiled kernel, or False if Numba isn't installed
+
+# Numba is optional: when present, 16-bit lookup table application runs as
+# a compiled loop, otherwise as a NumPy gather. The loop is serial, since
+# conversions already run concurrently on pool threads, where Numba's
+# parallel threading layers hang or abort; nogil lets them overlap.
+# Return the kernel, defining it on first use, or False without Numba.
+def _get_lookup_kernel():
+    global _lookup_kernel
+    if _lookup_kernel is None:
+        try:
+            from numba import njit
+        except ImportError:
+            _lookup_kernel = False
+        else:
+            # dst[r, c] = lut[src[r, c]]; src may be a non-contiguous view
+            @njit(nogil=True)
+            def lookup(src, lut, dst):
+                for r in range(src.shape[0]):
+                    for c in range(src.shape[1]):
+                        dst[r, c] = lut[src[r, c]]
+            _lookup_kernel = lookup
+    return _lookup_kernel
 
 # returns a copy of img with contrast maximized
-def adjust_contrast(img, colorDepth, gamma):
-    pmin, pmax = get_pixel_range(img)
+# out - optional uint16 array of img's shape to write the result into,
+# e.g. rows of a larger output image
+# pixelRange - optional (min, max) pixel value of img, if already known
+def adjust_contrast(img, colorDepth, gamma, out=None, pixelRange=None):
+    pmin, pmax = get_pixel_range(img) if pixelRange is None else pixelRange
     # print("pixel range = {} to {}".format(pmin, pmax))
     # print("unique pixel count = {}".format(count_unique_pixels(img)))
-    adjuster = ContrastAdjuster(pmin, pmax, gamma, (2 ** colorDepth) - 1)
-    # vectorize to apply adjuster.adjust() to every pixel in img
-    adjust_func = numpy.vectorize(adjuster.adjust)
-    adj_img = adjust_func(img)
-    return adj_img.astype('uint16') # adjust_func yields int64 array, convert to uint16
+    # An 8- or 16-bit image has at most 2 ** colorDepth distinct values, so
+    # adjust each possible value once and look up every pixel's result.
+    lut = make_contrast_lut(pmin, pmax, gamma, colorDepth)
+    if out is None:
+        out = numpy.empty(img.shape, dtype=lut.dtype)
+    if colorDepth == 8:
+        cv2.LUT(img, lut, dst=out) # OpenCV's vectorized lookup handles 8-bit input only
+        return out
+    kernel = _get_lookup_kernel()
+    if not kernel:
+        numpy.take(lut, img, out=out)
+    else:
+        kernel(img, lut, out)
+    return out
+
+# Decode ruler image file at rulerPath, preserving its color depth. The
+# result can be passed to prepare_xrf() as rulerImg, and shared by concurrent
+# conversions: it's marked read-only, so no conversion can modify it.
+def read_ruler_image(rulerPath):
+    ruler_img = cv2.imread(rulerPath, cv2.IMREAD_UNCHANGED)
+    if ruler_img is not None:
+        ruler_img.setflags(write=False)
+    return ruler_img
 
+# Return ruler image at rulerPath, prepared for a core image of colorDepth.
+# Prepared rulers are cached, so converting many images one prepare_xrf()
+# call at a time decodes each ruler once. The file's modification time is
+# part of the cache key: a ruler edited on disk is decoded again. Cached
+# rulers are shared by every caller, so they're read-only.
 def load_ruler_image(rulerPath, colorDepth):
-    ruler_img = cv2.imread(rulerPath, -1) # -1 to preserve file's color depth
+    return _load_ruler_image_cached(rulerPath, os.path.getmtime(rulerPath), colorDepth)
+
+@functools.lru_cache(maxsize=8)
+def _load_ruler_image_cached(rulerPath, mtime, colorDepth):
+    ruler_img = prepare_ruler_image(read_ruler_image(rulerPath), colorDepth, rulerPath)
+    ruler_img.setflags(write=False)
+    return ruler_img
+
+# Convert decoded ruler image ruler_img, loaded from rulerPath, to grayscale
+# with depth matching colorDepth. ruler_img itself is not modified, so one
+# decoded ruler can be reused for many XRF images.
+def prepare_ruler_image(ruler_img, colorDepth, rulerPath):
     rulerDepth = get_color_depth(ruler_img)
     if colorDepth is None:
         raise UnexpectedColorDepthError("Ruler image {} has an unrecognized color depth. Only 16-bit and 8-bit are accepted.".format(rulerPath))
@@ -99,48 +154,59 @@ def load_ruler_image(rulerPath, colorDepth):
 
     if rulerDepth == 8 and colorDepth == 16:
         print("Converting 8-bit ruler to 16-bit to match core image")
-        # ruler_img *= 256 alone doesn't work, must explicitly change array dtype
-        # from uint8 to uint16 first
+        # ruler_img <<= 8 alone doesn't work, must explicitly change array dtype
+        # from uint8 to uint16 first. Shifting in place reuses the astype() copy.
         ruler_img = ruler_img.astype('uint16')
-        ruler_img *= 256
+        ruler_img <<= 8
     elif rulerDepth == 16 and colorDepth == 8:
         print("Converting 16-bit ruler to 8-bit to match core image")
-        ruler8bit_img = ruler_img * 1/256.0 # float for Python 2, where 1/256 = 0
-        ruler_img = ruler8bit_img.astype('uint8')
+        ruler_img = convert_16_to_8bit(ruler_img)
     return ruler_img
 
 
 # rotate, adjust contrast, add ruler, save to destDir
-def prepare_xrf(imgPath, rulerPath, gamma, outputBaseName, destDir):
+# rulerImg - optional ruler image already decoded from rulerPath, to avoid
+# re-reading the same ruler file for each XRF image in a batch
+def prepare_xrf(imgPath, rulerPath, gamma, outputBaseName, destDir, rulerImg=None):
     baseProgStr = "Processing {}...".format(imgPath)
     reportProgress(0, baseProgStr)
     radiographDir = 'radiograph'
     create_dirs(destDir, [radiographDir])
 
-    img = cv2.imread(imgPath, -1)
-    img = numpy.rot90(img, k=2) # rotate 180 degrees so core top is at image left
-    imgWidth = img.shape[1]
+    img = cv2.imread(imgPath, cv2.IMREAD_UNCHANGED)
+    imgWidth = img.shape[1] # unchanged by the upcoming 180 degree rotation
     colorDepth = get_color_depth(img)
     component_count = get_component_count(img)
     if component_count in [3,4]:
         raise UnexpectedComponentCountError("Image {} appears to be {}. Only grayscale images are accepted.".format(imgPath, "RGBA" if component_count == 4 else 'RGB'))
     elif component_count != 1:
         raise UnexpectedComponentCountError("Image {} has an unexpected number of color components ({}). Only grayscale images are accepted.".format(imgPath, component_count))
-    ruler_img = load_ruler_image(rulerPath, colorDepth)
+    if rulerImg is None:
+        ruler_img = load_ruler_image(rulerPath, colorDepth)
+    else:
+        ruler_img = prepare_ruler_image(rulerImg, colorDepth, rulerPath)
     rulerWidth = ruler_img.shape[1]
     if rulerWidth < imgWidth:
         raise RulerTooShortError("Ruler image {} is too short for core image {}".format(rulerPath, imgPath))
 
+    # Output is allocated once at its final size: the rotated image is
+    # contrast-adjusted directly into its top rows, and the ruler, trimmed so
+    # its width matches the core image, is copied below. Slicing trims with a
+    # view rather than a copy. Adjusted pixels are always 16-bit, so the
+    # output is too.
+    ruler_img = ruler_img[:, :imgWidth]
+    imgHeight = img.shape[0]
+    tiff_img = numpy.empty((imgHeight + ruler_img.shape[0], imgWidth), dtype=numpy.result_type('uint16', ruler_img))
+
+    # Rotation doesn't change the pixel range, so find it in the contiguous
+    # image as read. Then rotate 180 degrees so core top is at image left.
+    # rot90() returns a reversed-stride view, not a copy: the contrast lookup
+    # reads through it and its output is the first copy of the rotated pixels.
     reportProgress(25, baseProgStr + "adjusting levels")
-    adj_img = adjust_contrast(img, colorDepth, gamma)
-    # print("adjusted image shape = {}, dtype = {}".format(adj_img.shape, adj_img.dtype))
-    # print("adj_img = {}".format(adj_img))
-
-    # Trim end of ruler so its width matches trimmed core image width, then
-    # add to bottom of core image. Image widths must be the same to stack vertically
-    # with numpy.concatenate().
-    ruler_img = numpy.delete(ruler_img, range(imgWidth, rulerWidth), axis=1)
-    tiff_img = numpy.concatenate((adj_img, ruler_img), axis=0)
+    pixelRange = get_pixel_range(img)
+    img = numpy.rot90(img, k=2)
+    adjust_contrast(img, colorDepth, gamma, out=tiff_img[:imgHeight], pixelRange=pixelRange)
+    numpy.copyto(tiff_img[imgHeight:], ruler_img)
 
     cv2.imwrite(os.path.join(destDir, radiographDir, outputBaseName + ".tif"), tiff_img)
 